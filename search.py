@@ -1,26 +1,62 @@
 import json
+from concurrent.futures import ThreadPoolExecutor
 
 import duckdb
 import geopandas as gpd
+import numpy as np
+import orjson
 import pandas as pd
-import plotly.express as px
+import plotly.graph_objects as go
+import pyarrow as pa
 import requests
+import shapely
 import streamlit as st
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+EARTH_AUTHALIC_RADIUS = 6371007.181
+
+OAM_MAX_WORKERS = 8
+OAM_SPLIT_MIN_PAGES = 50
+OAM_TILE_GRID = (4, 4)
+OAM_EXCLUDED_KEYS = frozenset(
+    {
+        "properties",
+        "bbox",
+        "footprint",
+        "user",
+        "projection",
+        "meta_uri",
+        "__v",
+        "geojson",
+    }
+)
+OAM_DATE_COLUMNS = ("uploaded_at", "acquisition_start", "acquisition_end")
+
 
-pd.options.plotting.backend = "plotly"
+@st.cache_resource
+def get_session():
+    session = requests.Session()
+    retries = Retry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=("GET",),
+    )
+    adapter = HTTPAdapter(pool_connections=16, pool_maxsize=16, max_retries=retries)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
 
 
+@st.cache_data(show_spinner=False, ttl=24 * 60 * 60)
 def fetch_iso3_bboxes():
-    try:
-        response = requests.get(
-            "https://raw.githubusercontent.com/kshitijrajsharma/global-boundaries-bbox/refs/heads/main/bbox.json"
-        )
-        response.raise_for_status()
-        bbox_data = response.json()
-        return bbox_data
-    except Exception as e:
-        st.error(f"Error fetching country data: {str(e)}")
-        return {}
+    response = requests.get(
+        "https://raw.githubusercontent.com/kshitijrajsharma/global-boundaries-bbox/refs/heads/main/bbox.json"
+    )
+    response.raise_for_status()
+    bbox_data = orjson.loads(response.content)
+    return bbox_data
 
 
 def calculate_bbox(geojson):
@@ -34,107 +70,179 @@ def calculate_bbox(geojson):
             for polygon in geometry["coordinates"]:
                 bounds.extend(polygon[0])
 
-    min_x = min(coord[0] for coord in bounds)
-    min_y = min(coord[1] for coord in bounds)
-    max_x = max(coord[0] for coord in bounds)
-    max_y = max(coord[1] for coord in bounds)
+    coords = np.asarray([coord[:2] for coord in bounds], dtype=np.float64)
+    min_x, min_y = coords.min(axis=0)
+    max_x, max_y = coords.max(axis=0)
+
+    return [float(min_x), float(min_y), float(max_x), float(max_y)]
+
 
-    return [min_x, min_y, max_x, max_y]
+def split_bbox(bbox, nx, ny):
+    xs = np.linspace(bbox[0], bbox[2], nx + 1)
+    ys = np.linspace(bbox[1], bbox[3], ny + 1)
+    return [
+        (float(xs[i]), float(ys[j]), float(xs[i + 1]), float(ys[j + 1]))
+        for i in range(nx)
+        for j in range(ny)
+    ]
 
 
+@st.cache_data(show_spinner=False, ttl=60 * 60)
 def fetch_openaerialmap_data(bbox=None, from_date=None, to_date=None):
     base_url = "https://api.openaerialmap.org/meta"
     params = {"limit": 100}
 
-    if bbox:
-        params["bbox"] = ",".join(map(str, bbox))
-
     if from_date:
         params["acquisition_from"] = from_date.strftime("%Y-%m-%d")
 
     if to_date:
         params["acquisition_to"] = to_date.strftime("%Y-%m-%d")
 
-    all_results = []
-    page = 1
-    while True:
-        params["page"] = page
-        response = requests.get(base_url, params=params)
-        data = response.json()
+    session = get_session()
 
-        all_results.extend(data["results"])
+    def fetch_page(area, page):
+        query = {**params, "page": page}
+        if area:
+            query["bbox"] = ",".join(map(str, area))
+        response = session.get(base_url, params=query)
+        response.raise_for_status()
+        return orjson.loads(response.content)
 
-        total_results = data["meta"]["found"]
+    def page_count(data):
         limit = data["meta"]["limit"]
-        if len(all_results) >= total_results:
-            break
-        page += 1
+        return -(-data["meta"]["found"] // limit) if limit else 1
+
+    areas = [bbox]
+    first_pages = [fetch_page(bbox, 1)]
+    seed_pages = []
+
+    with ThreadPoolExecutor(max_workers=OAM_MAX_WORKERS) as executor:
+        if bbox and page_count(first_pages[0]) >= OAM_SPLIT_MIN_PAGES:
+            seed_pages = first_pages
+            areas = split_bbox(bbox, *OAM_TILE_GRID)
+            first_pages = list(executor.map(fetch_page, areas, [1] * len(areas)))
+
+        page_areas = []
+        page_numbers = []
+        for area, data in zip(areas, first_pages):
+            for page in range(2, page_count(data) + 1):
+                page_areas.append(area)
+                page_numbers.append(page)
+        pages = seed_pages + first_pages
+        pages += executor.map(fetch_page, page_areas, page_numbers)
+
+    all_results = []
+    seen_ids = set()
+    for data in pages:
+        for result in data["results"]:
+            if result["_id"] not in seen_ids:
+                seen_ids.add(result["_id"])
+                all_results.append(result)
 
     return all_results
 
 
+def result_bounds(result):
+    if result.get("bbox"):
+        return result["bbox"]
+    if result.get("geojson"):
+        return shapely.geometry.shape(result["geojson"]).bounds
+    return [np.nan] * 4
+
+
 def create_geodataframe(data):
-    features = []
-    for result in data:
+    columns = {}
+    bboxes = []
+    for i, result in enumerate(data):
+        row = dict(result["properties"])
         for key, value in result.items():
-            if key not in [
-                "properties",
-                "bbox",
-                "footprint",
-                "user",
-                "projection",
-                "meta_uri",
-                "__v",
-                "geojson",
-            ]:
-                result["properties"][key] = value
-        properties = result["properties"]
-        geometry = result["geojson"]
-        features.append({"geometry": geometry, "properties": properties})
-
-    gdf = gpd.GeoDataFrame.from_features(features, crs=4326)
-    gdf_proj = gdf.to_crs(epsg=3857)
-    gdf_proj["area_sqm"] = gdf_proj.geometry.area
-    gdf_proj_back = gdf_proj.to_crs(epsg=4326)
-    gdf_proj_back["geometry"] = gdf_proj_back.geometry.envelope
-
-    return gdf_proj_back
+            if key not in OAM_EXCLUDED_KEYS:
+                row[key] = value
+        for key, value in row.items():
+            if key not in columns:
+                columns[key] = [None] * len(data)
+            columns[key][i] = value
+        bboxes.append(result_bounds(result))
+
+    for key in OAM_DATE_COLUMNS:
+        if key in columns:
+            columns[key] = pd.to_datetime(
+                columns[key], format="ISO8601", utc=True, errors="coerce"
+            )
+
+    bounds = np.asarray(bboxes, dtype=np.float64).reshape(-1, 4)
+    min_x, min_y, max_x, max_y = bounds.T
+    geoms = shapely.box(min_x, min_y, max_x, max_y)
+    gdf = gpd.GeoDataFrame(columns, geometry=geoms, crs=4326)
+    width = max_x - min_x
+    width = np.where(width < 0, width + 360, width)
+    gdf["area_sqm"] = (
+        EARTH_AUTHALIC_RADIUS**2
+        * np.radians(width)
+        * np.abs(np.sin(np.radians(max_y)) - np.sin(np.radians(min_y)))
+    )
+
+    return gdf
+
+
+def to_export_frame(gdf):
+    export = gdf.copy(deep=False)
+    for key in OAM_DATE_COLUMNS:
+        if key in export:
+            export[key] = export[key].dt.strftime("%Y-%m-%dT%H:%M:%S.%f").str[:-3] + "Z"
+    return export
 
 
 def create_chart(df, x_col, y_col, chart_type, time_interval="year"):
     try:
-        df[x_col] = pd.to_datetime(df[x_col], errors="coerce")
+        timestamps = df[x_col]
+        if not pd.api.types.is_datetime64_any_dtype(timestamps):
+            timestamps = pd.to_datetime(timestamps, errors="coerce")
+        if timestamps.dt.tz is not None:
+            timestamps = timestamps.dt.tz_convert(None)
 
         if time_interval == "year":
-            df["time_group"] = df[x_col].dt.year
+            time_key = timestamps.dt.year.rename("time_group")
         elif time_interval == "month":
-            df["time_group"] = df[x_col].dt.to_period("M").astype(str)
+            time_key = pd.Series(
+                timestamps.to_numpy().astype("datetime64[M]"),
+                index=df.index,
+                name="time_group",
+            )
         else:
             raise ValueError("Unsupported time_interval. Use 'year' or 'month'.")
 
-        grouped_df = df.groupby(["time_group", y_col]).size().reset_index(name="count")
-        grouped_df = grouped_df.sort_values(by="time_group")
+        grouped_df = (
+            df.groupby([time_key, y_col], sort=True).size().reset_index(name="count")
+        )
 
         if chart_type == "line":
-            fig = px.line(
-                grouped_df,
-                x="time_group",
-                y="count",
-                color=y_col,
-                title=f"{y_col} Uploads by {time_interval.capitalize()}",
-                markers=True,
-            )
+            trace = go.Scatter
+            trace_kwargs = {"mode": "lines+markers"}
         elif chart_type == "bar":
-            fig = px.bar(
-                grouped_df,
-                x="time_group",
-                y="count",
-                color=y_col,
-                title=f"{y_col} Uploads by {time_interval.capitalize()}",
-            )
+            trace = go.Bar
+            trace_kwargs = {}
         else:
             raise ValueError("Unsupported chart type. Use 'line' or 'bar'.")
 
+        fig = go.Figure()
+        for category, group in grouped_df.groupby(y_col, sort=False):
+            fig.add_trace(
+                trace(
+                    x=group["time_group"].to_numpy(),
+                    y=group["count"].to_numpy(),
+                    name=str(category),
+                    **trace_kwargs,
+                )
+            )
+        fig.update_layout(
+            title=f"{y_col} Uploads by {time_interval.capitalize()}",
+            xaxis_title="time_group",
+            yaxis_title="count",
+            legend_title=y_col,
+            barmode="relative",
+        )
+
         return fig
 
     except Exception as e:
@@ -142,11 +250,34 @@ def create_chart(df, x_col, y_col, chart_type, time_interval="year"):
         return None
 
 
-def execute_duckdb_query(df, query):
-    try:
+def get_duckdb():
+    if "duckdb" not in st.session_state:
         con = duckdb.connect(database=":memory:")
-        con.register("data", df)
-        result = con.execute(query).fetchdf()
+        con.execute("PRAGMA threads=4")
+        st.session_state["duckdb"] = con
+    return st.session_state["duckdb"]
+
+
+def register_duckdb_data(df):
+    con = get_duckdb()
+    try:
+        data = pa.Table.from_pandas(df, preserve_index=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        data = df
+    con.register("data", data)
+    return con
+
+
+def arrow_to_pandas(table):
+    for i, field in enumerate(table.schema):
+        if pa.types.is_decimal(field.type):
+            table = table.set_column(i, field.name, table.column(i).cast(pa.float64()))
+    return table.to_pandas(split_blocks=True)
+
+
+def execute_duckdb_query(con, query):
+    try:
+        result = con.execute(query).arrow()
         return result
     except Exception as e:
         st.error(f"Error executing query: {str(e)}")
@@ -172,7 +303,11 @@ bbox = None
 geojson = None
 
 if area_selection_method == "Select Country (ISO3)":
-    iso3_data = fetch_iso3_bboxes()
+    try:
+        iso3_data = fetch_iso3_bboxes()
+    except Exception as e:
+        st.error(f"Error fetching country data: {str(e)}")
+        iso3_data = {}
     if iso3_data:
         country_codes = sorted(iso3_data.keys())
         selected_country = st.selectbox("Select Country (ISO3)", country_codes)
@@ -222,19 +357,29 @@ if st.button("Fetch Data"):
         st.warning("No filters selected. This might return a large amount of data")
 
     with st.spinner("Fetching data..."):
-        data = fetch_openaerialmap_data(bbox, from_date, to_date)
+        try:
+            data = fetch_openaerialmap_data(
+                tuple(bbox) if bbox else None, from_date, to_date
+            )
+        except requests.RequestException as e:
+            st.error(f"Error fetching OpenAerialMap data: {str(e)}")
+            data = []
         if data:
             gdf = create_geodataframe(data)
-            st.session_state["gdf"] = gdf
+            df = pd.DataFrame(gdf.drop(columns="geometry"))
+            st.session_state["gdf"] = df
+
+            con = register_duckdb_data(df)
+            total_features = con.execute("SELECT COUNT(*) FROM data").fetchone()[0]
 
             st.subheader("Result")
-            st.text(f"Total Features: {len(gdf)}")
-            df = pd.DataFrame(gdf)
-            df.drop("geometry", axis=1, inplace=True)
-            st.write(df.head(100))
-            if len(gdf) > 0:
+            st.text(f"Total Features: {total_features}")
+            preview = con.execute("SELECT * FROM data LIMIT 100").arrow()
+            st.write(arrow_to_pandas(preview))
+            if total_features > 0:
+                export_gdf = to_export_frame(gdf)
 
-                geojson_data = gdf.to_json()
+                geojson_data = export_gdf.to_json()
                 st.download_button(
                     label="Download GeoJSON",
                     data=geojson_data,
@@ -242,7 +387,7 @@ if st.button("Fetch Data"):
                     mime="application/json",
                 )
 
-                csv_data = gdf.to_csv(index=False)
+                csv_data = export_gdf.to_csv(index=False)
                 st.download_button(
                     label="Download CSV",
                     data=csv_data,
@@ -256,7 +401,7 @@ if st.button("Fetch Data"):
 
             st.subheader("Custom SQL Query")
             if query:
-                result = execute_duckdb_query(df, query)
+                result = execute_duckdb_query(con, query)
                 if result is not None:
-                    st.write(f"Query returned {len(result)} rows")
-                    st.write(result)
+                    st.write(f"Query returned {result.num_rows} rows")
+                    st.write(arrow_to_pandas(result))